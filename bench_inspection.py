@@ -0,0 +1,100 @@
+import cv2
+import numpy as np
+import sys
+import time
+import tracemalloc
+from defect_demo import align_images, estimate_homography, InspectionContext
+
+# ========== 配置 ==========
+TEMPLATE_PATH = "template.jpg"
+TEST_PATH = "temp_test.jpg"
+ROUNDS = 50
+# =========================
+
+def fresh_pipeline(aligned, test):
+    """差影、阈值、形态学与标注，每一步都新分配结果数组"""
+    gray_aligned = cv2.cvtColor(aligned, cv2.COLOR_BGR2GRAY)
+    gray_test = cv2.cvtColor(test, cv2.COLOR_BGR2GRAY)
+    diff = cv2.absdiff(gray_test, gray_aligned)
+    _, thresh = cv2.threshold(diff, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5,5))
+    opened = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
+    clean = cv2.morphologyEx(opened, cv2.MORPH_CLOSE, kernel)
+    contours, _ = cv2.findContours(clean, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    annotated = test.copy()
+    for cnt in contours:
+        if cv2.contourArea(cnt) > 200:
+            x, y, w_box, h_box = cv2.boundingRect(cnt)
+            cv2.rectangle(annotated, (x, y), (x+w_box, y+h_box), (0,0,255), 2)
+    return annotated
+
+def legacy_inspect(template, test):
+    """旧流程：每帧重新提取模板特征、分配全部中间结果"""
+    aligned, _ = align_images(template, test)
+    if aligned is None:
+        return None
+    return fresh_pipeline(aligned, test)
+
+class CachedFeatureInspector:
+    """仅缓存模板特征、仍逐帧分配中间结果，用于单独衡量缓冲区复用的收益"""
+
+    def __init__(self, template, max_features=500):
+        self.template = template
+        self.orb = cv2.ORB_create(max_features)
+        self.bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        gray_template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+        self.kp, self.des = self.orb.detectAndCompute(gray_template, None)
+
+    def inspect(self, test):
+        gray_test = cv2.cvtColor(test, cv2.COLOR_BGR2GRAY)
+        kp2, des2 = self.orb.detectAndCompute(gray_test, None)
+        H, _ = estimate_homography(self.kp, self.des, kp2, des2, self.bf)
+        if H is None:
+            return None
+        h, w = gray_test.shape
+        aligned = cv2.warpPerspective(self.template, H, (w, h))
+        return fresh_pipeline(aligned, test)
+
+def run(name, fn, frames):
+    """先在不开启 tracemalloc 的情况下逐帧计时，避免追踪开销影响延迟；
+    再逐帧单独开启 tracemalloc，统计该帧的峰值内存（含帧内分配后已释放的临时数组）。
+    tracemalloc 只保留存活的分配，无法统计帧内分配后又释放的次数，故以峰值内存衡量分配量"""
+    fn(frames[0])  # 预热
+    times = []
+    for frame in frames:
+        t0 = time.perf_counter()
+        fn(frame)
+        times.append(time.perf_counter() - t0)
+    peaks = []
+    for frame in frames:
+        tracemalloc.start()
+        fn(frame)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak)
+    times.sort()
+    peaks.sort()
+    print(f"{name:<14} 中位 {times[len(times)//2]*1000:7.2f} ms  "
+          f"P95 {times[int(len(times)*0.95)]*1000:7.2f} ms  "
+          f"每帧峰值内存 中位 {peaks[len(peaks)//2]/1024/1024:6.2f} MB  "
+          f"最大 {peaks[-1]/1024/1024:6.2f} MB")
+
+def main():
+    template = cv2.imread(TEMPLATE_PATH)
+    test = cv2.imread(TEST_PATH)
+    if template is None or test is None:
+        print("❌ 图片读取失败，检查路径")
+        sys.exit(1)
+    # 同一分辨率下轻微变化的帧序列，模拟相机连续采集
+    rng = np.random.default_rng(0)
+    frames = [cv2.add(test, rng.integers(0, 8, test.shape, dtype=np.uint8)) for _ in range(ROUNDS)]
+
+    print(f"📊 分辨率 {test.shape[1]}x{test.shape[0]}，共 {ROUNDS} 帧")
+    run("legacy", lambda f: legacy_inspect(template, f), frames)
+    run("cached-feature", CachedFeatureInspector(template).inspect, frames)
+    ctx = InspectionContext(template)
+    run("context", ctx.inspect, frames)
+    print(f"context 缓冲区重建次数：{ctx.allocations}")
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ import numpy as np
 import csv
 from datetime import datetime
 import os
+import threading
 import time
 import defect_report  # 导入日报模块，用于直接调用
 
@@ -10,55 +11,139 @@ import defect_report  # 导入日报模块，用于直接调用
 last_report_time = 0
 REPORT_COOLDOWN = 10  # 秒
 
-def align_images(template, target, max_features=500):
-    gray_template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
-    gray_target = cv2.cvtColor(target, cv2.COLOR_BGR2GRAY)
-    orb = cv2.ORB_create(max_features)
-    kp1, des1 = orb.detectAndCompute(gray_template, None)
-    kp2, des2 = orb.detectAndCompute(gray_target, None)
-    if des2 is None or len(kp2) < 4:
+def estimate_homography(kp1, des1, kp2, des2, bf):
+    """匹配模板与目标的 ORB 特征并估计单应矩阵，返回 (H, 有效匹配数)；失败时 H 为 None"""
+    if des1 is None or des2 is None or len(kp2) < 4:
         return None, 0
-    bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
     matches = bf.match(des1, des2)
     matches = sorted(matches, key=lambda x: x.distance)
     if len(matches) < 4:
         return None, 0
     good_matches = matches[:int(len(matches)*0.3)]
+    # findHomography 至少需要 4 对点，否则直接抛 cv2.error
+    if len(good_matches) < 4:
+        return None, len(good_matches)
     src_pts = np.float32([kp1[m.queryIdx].pt for m in good_matches]).reshape(-1,1,2)
     dst_pts = np.float32([kp2[m.trainIdx].pt for m in good_matches]).reshape(-1,1,2)
     H, _ = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
+    return H, len(good_matches)
+
+def align_images(template, target, max_features=500):
+    gray_template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+    gray_target = cv2.cvtColor(target, cv2.COLOR_BGR2GRAY)
+    orb = cv2.ORB_create(max_features)
+    kp1, des1 = orb.detectAndCompute(gray_template, None)
+    kp2, des2 = orb.detectAndCompute(gray_target, None)
+    bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+    H, match_count = estimate_homography(kp1, des1, kp2, des2, bf)
     if H is None:
-        return None, 0
+        return None, match_count
     h, w = gray_target.shape
     aligned = cv2.warpPerspective(template, H, (w, h))
-    return aligned, len(good_matches)
+    return aligned, match_count
+
+class InspectionContext:
+    """常驻检测上下文：缓存模板特征与形态学核，按分辨率预分配中间缓冲区，
+    稳态下各步骤均通过 dst= 写入已有缓冲区，仅在画面尺寸变化时重新分配"""
+
+    def __init__(self, template, max_features=500, kernel_size=(5, 5), features=None):
+        self.template = template
+        self.orb = cv2.ORB_create(max_features)
+        self.bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, kernel_size)
+        # features 为已提取的 (关键点, 描述子)，多个上下文共用同一模板时可避免重复提取
+        if features is None:
+            gray_template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+            features = self.orb.detectAndCompute(gray_template, None)
+        self.kp_template, self.des_template = features
+        self.shape = None
+        self.allocations = 0  # 缓冲区分配次数（基准测试用）
+
+    def _ensure_buffers(self, shape):
+        if shape == self.shape:
+            return
+        h, w = shape[:2]
+        self.gray_test = np.empty((h, w), np.uint8)
+        self.aligned = np.empty((h, w, 3), np.uint8)
+        self.gray_aligned = np.empty((h, w), np.uint8)
+        self.diff = np.empty((h, w), np.uint8)
+        self.thresh = np.empty((h, w), np.uint8)
+        self.opened = np.empty((h, w), np.uint8)
+        self.clean = np.empty((h, w), np.uint8)
+        self.annotated = np.empty((h, w, 3), np.uint8)
+        self.shape = shape
+        self.allocations += 1
+
+    def _homography(self):
+        kp2, des2 = self.orb.detectAndCompute(self.gray_test, None)
+        return estimate_homography(self.kp_template, self.des_template, kp2, des2, self.bf)
+
+    def inspect(self, test, min_area=200):
+        """检测单帧，返回 (缺陷数, 匹配数, 缺陷框列表)；对齐失败时缺陷数为 None。
+        标注结果写入 self.annotated，不修改传入的 test"""
+        self._ensure_buffers(test.shape)
+        cv2.cvtColor(test, cv2.COLOR_BGR2GRAY, dst=self.gray_test)
+        H, match_count = self._homography()
+        if H is None:
+            return None, match_count, []
+        h, w = self.gray_test.shape
+        cv2.warpPerspective(self.template, H, (w, h), dst=self.aligned)
+        cv2.cvtColor(self.aligned, cv2.COLOR_BGR2GRAY, dst=self.gray_aligned)
+        cv2.absdiff(self.gray_test, self.gray_aligned, dst=self.diff)
+        cv2.threshold(self.diff, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=self.thresh)
+        cv2.morphologyEx(self.thresh, cv2.MORPH_OPEN, self.kernel, dst=self.opened)
+        cv2.morphologyEx(self.opened, cv2.MORPH_CLOSE, self.kernel, dst=self.clean)
+        contours, _ = cv2.findContours(self.clean, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        np.copyto(self.annotated, test)
+        boxes = []
+        for cnt in contours:
+            area = cv2.contourArea(cnt)
+            if area > min_area:
+                x, y, w_box, h_box = cv2.boundingRect(cnt)
+                boxes.append((x, y, w_box, h_box))
+                cv2.rectangle(self.annotated, (x, y), (x+w_box, y+h_box), (0,0,255), 2)
+        return len(boxes), match_count, boxes
+
+# 按模板路径缓存检测上下文，模板文件更新时自动重建
+_contexts = {}
+# 上下文内含复用缓冲区，get_context 返回的上下文不能被多个线程同时使用；
+# detect_defect 在检测、标注与保存结果期间持有此锁
+_context_lock = threading.Lock()
+
+def get_context(template_path):
+    """按模板路径取缓存的检测上下文，模板读取失败时返回 None（非线程安全，调用方需持有 _context_lock）"""
+    try:
+        mtime = os.path.getmtime(template_path)
+    except OSError:
+        return None
+    cached = _contexts.get(template_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    template = cv2.imread(template_path)
+    if template is None:
+        return None
+    ctx = InspectionContext(template)
+    _contexts[template_path] = (mtime, ctx)
+    return ctx
 
 def detect_defect(template_path, test_path, output_path="result.jpg"):
     global last_report_time
-    template = cv2.imread(template_path)
     test = cv2.imread(test_path)
-    if template is None or test is None:
-        print("❌ 图片读取失败，检查路径")
-        return
-    aligned, match_count = align_images(template, test)
-    if aligned is None:
-        print(f"❌ 对齐失败，特征点匹配数：{match_count}")
-        return
-    gray_aligned = cv2.cvtColor(aligned, cv2.COLOR_BGR2GRAY)
-    gray_test = cv2.cvtColor(test, cv2.COLOR_BGR2GRAY)
-    diff = cv2.absdiff(gray_test, gray_aligned)
-    _, thresh = cv2.threshold(diff, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5,5))
-    clean = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
-    clean = cv2.morphologyEx(clean, cv2.MORPH_CLOSE, kernel)
-    contours, _ = cv2.findContours(clean, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    defect_cnt = 0
-    for cnt in contours:
-        area = cv2.contourArea(cnt)
-        if area > 200:
-            defect_cnt += 1
-            x, y, w_box, h_box = cv2.boundingRect(cnt)
-            cv2.rectangle(test, (x, y), (x+w_box, y+h_box), (0,0,255), 2)
+    with _context_lock:
+        ctx = get_context(template_path)
+        if ctx is None or test is None:
+            print("❌ 图片读取失败，检查路径")
+            return
+        defect_cnt, match_count, _ = ctx.inspect(test)
+        if defect_cnt is None:
+            print(f"❌ 对齐失败，特征点匹配数：{match_count}")
+            return
+        result = ctx.annotated
+        label = f"Defect: {defect_cnt}" if defect_cnt > 0 else "OK"
+        color = (0,0,255) if defect_cnt > 0 else (0,255,0)
+        cv2.putText(result, label, (30,50), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
+        cv2.putText(result, f"Matches: {match_count}", (30,100), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255,0,0), 2)
+        cv2.imwrite(output_path, result)
 
     # 记录检测结果到CSV（仅当有缺陷时）
     if defect_cnt > 0:
@@ -83,11 +168,6 @@ def detect_defect(template_path, test_path, output_path="result.jpg"):
         except Exception as e:
             print(f"CSV写入失败：{e}")
 
-    label = f"Defect: {defect_cnt}" if defect_cnt > 0 else "OK"
-    color = (0,0,255) if defect_cnt > 0 else (0,255,0)
-    cv2.putText(test, label, (30,50), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
-    cv2.putText(test, f"Matches: {match_count}", (30,100), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255,0,0), 2)
-    cv2.imwrite(output_path, test)
     print(f"✅ 检测完成，缺陷数：{defect_cnt}，结果已保存至 {output_path}")
     return defect_cnt
 
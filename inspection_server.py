@@ -0,0 +1,332 @@
+import cv2
+import numpy as np
+import json
+import os
+import queue
+import selectors
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from defect_demo import InspectionContext
+
+# ========== 配置 ==========
+HOST = "127.0.0.1"  # 仅监听本机，供 MES / PLC 网关调用
+PORT = 8765
+TEMPLATES = {       # 模板名 -> 模板路径，请求通过 ?template=名称 选择，缺省为 default
+    "default": "template.jpg",
+}
+WORKERS = 4         # 并发检测数（每个模板为每个工作槽准备独立的检测上下文）
+QUEUE_DEPTH = 8     # 排队上限，超出直接返回 503
+MAX_BODY = 32 * 1024 * 1024
+TEMPLATE_SETTLE = 1.0  # 模板文件修改后需静置的时间 (秒)，避免读到写了一半的文件
+READ_TIMEOUT = 10.0  # 读取请求头与请求体的超时 (秒)，超时释放工作槽，防止空闲或卡住的连接占满队列
+DRAIN_TIMEOUT = 2.0  # 被拒连接丢弃剩余请求体的最长时间 (秒)
+# =========================
+
+BUSY_BODY = json.dumps({"error": "检测队列已满，请稍后重试"}, ensure_ascii=False).encode("utf-8")
+BUSY_RESPONSE = (
+    b"HTTP/1.0 503 Service Unavailable\r\n"
+    b"Content-Type: application/json; charset=utf-8\r\n"
+    b"Content-Length: " + str(len(BUSY_BODY)).encode() + b"\r\n"
+    b"Connection: close\r\n\r\n" + BUSY_BODY
+)
+
+class TemplatePool:
+    """单个模板的检测上下文池：上下文内含复用缓冲区，不能跨线程共享，
+    因此每个工作槽一个上下文（共用同一份模板特征）；模板文件修改后自动重建。
+    模板文件应以“写入临时文件再改名”的方式原子替换；若原地改写，
+    仅在文件静置 TEMPLATE_SETTLE 秒且读取前后大小、修改时间不变时才接受新模板，
+    否则继续使用旧模板并在后续请求中重试"""
+
+    def __init__(self, path, workers=WORKERS):
+        self.path = path
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.contexts = None
+        self.reload()
+
+    def reload(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            if self.contexts is None:
+                raise
+            return
+        stamp = (st.st_mtime, st.st_size)
+        if stamp == self.stamp:
+            return
+        if self.contexts is not None and time.time() - st.st_mtime < TEMPLATE_SETTLE:
+            return  # 文件可能仍在写入
+        # 已有可用模板时，仅由一个请求负责重建，其他请求继续使用旧上下文
+        if not self.lock.acquire(blocking=self.contexts is None):
+            return
+        try:
+            if stamp == self.stamp:
+                return
+            template = cv2.imread(self.path)
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                st = None
+            if template is None or st is None or (st.st_mtime, st.st_size) != stamp:
+                if self.contexts is None:
+                    raise ValueError(f"模板读取失败：{self.path}")
+                return
+            first = InspectionContext(template)
+            features = (first.kp_template, first.des_template)
+            contexts = queue.Queue()
+            contexts.put(first)
+            for _ in range(self.workers - 1):
+                contexts.put(InspectionContext(template, features=features))
+            # 正在使用旧上下文的请求完成后归还到旧队列，随后被回收
+            self.contexts = contexts
+            self.stamp = stamp
+        finally:
+            self.lock.release()
+
+    def inspect(self, image):
+        """返回 (缺陷数, 匹配数, 缺陷框)；异常时上下文同样归还"""
+        self.reload()
+        contexts = self.contexts
+        ctx = contexts.get()
+        try:
+            return ctx.inspect(image)
+        finally:
+            contexts.put(ctx)
+
+class RejectDrainer:
+    """被拒连接直接关闭会因未读数据触发 RST，客户端收不到 503；
+    由单个后台线程丢弃其剩余请求体（不保存、不解码），超时或对端关闭后再关闭"""
+
+    def __init__(self, timeout=DRAIN_TIMEOUT):
+        self.timeout = timeout
+        self.pending = queue.Queue()
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def add(self, sock):
+        try:
+            sock.setblocking(False)
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            sock.close()
+            return
+        self.pending.put(sock)
+
+    def loop(self):
+        sel = selectors.DefaultSelector()
+        deadlines = {}
+        while True:
+            # 空闲时阻塞等待新连接，否则非阻塞地取走全部新连接
+            try:
+                sock = self.pending.get(block=not deadlines)
+                while True:
+                    sel.register(sock, selectors.EVENT_READ)
+                    deadlines[sock] = time.monotonic() + self.timeout
+                    sock = self.pending.get_nowait()
+            except queue.Empty:
+                pass
+            for key, _ in sel.select(timeout=0.05):
+                try:
+                    done = not key.fileobj.recv(65536)
+                except BlockingIOError:
+                    done = False
+                except OSError:
+                    done = True
+                if done:
+                    deadlines[key.fileobj] = 0
+            now = time.monotonic()
+            for sock in [s for s, d in deadlines.items() if d <= now]:
+                sel.unregister(sock)
+                sock.close()
+                del deadlines[sock]
+
+class InspectionServer(ThreadingHTTPServer):
+    """在接受连接时做准入控制：在途加排队的请求数超过上限时直接回 503，
+    不再为其创建线程、读取请求体；实际检测再由 running 限制为 WORKERS 路并发"""
+
+    daemon_threads = True
+
+    def __init__(self, address, pools, workers=WORKERS, queue_depth=QUEUE_DEPTH):
+        super().__init__(address, InspectionHandler)
+        self.pools = pools
+        self.admission = threading.BoundedSemaphore(workers + queue_depth)
+        self.running = threading.BoundedSemaphore(workers)
+        self.drainer = RejectDrainer()
+        self.handed_off = set()
+
+    def hand_off(self, request):
+        """已回复错误但请求体未读完的连接交给 drainer 关闭，避免直接关闭触发 RST"""
+        self.handed_off.add(request)
+        self.drainer.add(request)
+
+    def shutdown_request(self, request):
+        if request in self.handed_off:
+            self.handed_off.discard(request)
+            return
+        super().shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        if not self.admission.acquire(blocking=False):
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except OSError:
+                request.close()
+                return
+            self.drainer.add(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self.admission.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.admission.release()
+
+def decode_image(body, content_type, params):
+    """支持编码图片（jpg/png 等）和原始 BGR 缓冲区（需 width、height 参数）"""
+    if content_type == "application/x-raw-bgr":
+        try:
+            w = int(params["width"][0])
+            h = int(params["height"][0])
+        except (KeyError, ValueError):
+            raise ValueError("原始缓冲区需要 width 和 height 参数")
+        if len(body) != w * h * 3:
+            raise ValueError(f"缓冲区长度 {len(body)} 与 {w}x{h}x3 不符")
+        return np.frombuffer(body, np.uint8).reshape(h, w, 3)
+    image = cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("图片解码失败")
+    return image
+
+class InspectionHandler(BaseHTTPRequestHandler):
+    timeout = READ_TIMEOUT
+
+    def send_json(self, status, payload, close=False):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        if close:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def reject(self, status, payload):
+        """请求体尚未读取时回复错误：回复后由 drainer 丢弃剩余请求体再关闭连接"""
+        self.close_connection = True
+        self.send_json(status, payload, close=True)
+        self.wfile.flush()
+        self.server.hand_off(self.request)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/health":
+            self.send_json(200, {"status": "ok", "templates": sorted(self.server.pools)})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        t_start = time.perf_counter()
+        url = urlparse(self.path)
+        if url.path != "/inspect":
+            self.reject(404, {"error": "not found"})
+            return
+        params = parse_qs(url.query)
+        name = params.get("template", ["default"])[0]
+        pool = self.server.pools.get(name)
+        if pool is None:
+            self.reject(400, {"error": f"未知模板：{name}"})
+            return
+        # 不支持分块传输，必须给出合法的 Content-Length
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            self.reject(400, {"error": "不支持分块传输，请提供 Content-Length"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            self.reject(400, {"error": "缺少或非法的 Content-Length"})
+            return
+        if length <= 0 or length > MAX_BODY:
+            self.reject(413 if length > MAX_BODY else 400, {"error": "请求体为空或过大"})
+            return
+        try:
+            body = self.rfile.read(length)
+        except socket.timeout:
+            self.close_connection = True
+            self.send_json(408, {"error": "读取请求体超时"}, close=True)
+            return
+        if len(body) != length:
+            self.send_json(400, {"error": "请求体不完整"})
+            return
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip()
+
+        t_wait = time.perf_counter()
+        with self.server.running:
+            t_run = time.perf_counter()
+            try:
+                image = decode_image(body, content_type, params)
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            t_decoded = time.perf_counter()
+            try:
+                defect_cnt, match_count, boxes = pool.inspect(image)
+            except Exception as e:
+                self.send_json(500, {"error": f"检测过程发生错误：{e}"})
+                return
+        t_done = time.perf_counter()
+        timings = {
+            "queue_ms": round((t_run - t_wait) * 1000, 2),
+            "decode_ms": round((t_decoded - t_run) * 1000, 2),
+            "inspect_ms": round((t_done - t_decoded) * 1000, 2),
+            "total_ms": round((t_done - t_start) * 1000, 2),
+        }
+        if defect_cnt is None:
+            self.send_json(422, {"error": "对齐失败", "matches": match_count, "timings": timings})
+            return
+        self.send_json(200, {
+            "template": name,
+            "verdict": "NG" if defect_cnt > 0 else "OK",
+            "defects": defect_cnt,
+            "matches": match_count,
+            "boxes": [list(b) for b in boxes],
+            "timings": timings,
+        })
+
+    def log_message(self, format, *args):
+        pass  # 高频调用下不逐条打印访问日志
+
+def main():
+    pools = {}
+    for name, path in TEMPLATES.items():
+        try:
+            pools[name] = TemplatePool(path)
+        except FileNotFoundError:
+            print(f"❌ 错误：找不到模板文件 {path}")
+            sys.exit(1)
+        except (OSError, ValueError) as e:
+            print(f"❌ 错误：模板 {name} 加载失败：{e}")
+            sys.exit(1)
+    try:
+        server = InspectionServer((HOST, PORT), pools)
+    except OSError as e:
+        print(f"❌ 错误：无法监听 {HOST}:{PORT}（端口可能已被占用）：{e}")
+        sys.exit(1)
+    print(f"🚀 检测服务已启动：http://{HOST}:{PORT}/inspect "
+          f"（模板 {', '.join(pools)}，{WORKERS} 个工作槽，排队上限 {QUEUE_DEPTH}）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("👋 检测服务退出")
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()